@@ -1,15 +1,17 @@
 # Author: Danny Milsom <danny.milsom@cgi.com>
 # Copyright (C) 2014 CGI IT UK Ltd
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
+import sys
 
 from trac.admin import AdminCommandError, IAdminCommandProvider
-from trac.core import Component, implements
+from trac.core import Component, TracError, implements
 from trac.resource import ResourceNotFound
-from trac.util.datefmt import to_utimestamp
+from trac.util.datefmt import parse_date, to_utimestamp, utc
 
-from projectmessage.models import ProjectMessage
+from projectmessage import export
+from projectmessage.models import ProjectMessage, ProjectMessageRecord
 
 
 class ProjectMessageAdmin(Component):
@@ -35,9 +37,63 @@ class ProjectMessageAdmin(Component):
                """
                ,
                None, self._insert_message)
+        yield ('projectmessage export', 
+               '<format> [user] [message] [from] [to]',
+               """
+               Writes project message records to stdout.
+
+               Pass an empty string to skip an optional argument.
+
+               :param string: format ('csv' or 'json')
+               :param string: optional user whose records are exported
+               :param string: optional name of the message whose records are exported
+               :param string: optional first date records were agreed on (ISO-8601 26-07-2014)
+               :param string: optional last date records were agreed on (ISO-8601 30-07-2014)
+
+               """
+               ,
+               self._complete_export, self._export_records)
 
     # Other class methods
 
+    def _complete_export(self, args):
+        if len(args) == 1:
+            return sorted(export.formats)
+
+    def _export_records(self, format, user=None, message=None, 
+                        start=None, end=None):
+        """
+        Streams the project message records to stdout in the given 
+        format, reading them from the database in chunks.
+
+        The filters are the same as the records admin panel's. Dates are 
+        inclusive, and are in UTC.
+        """
+
+        if format not in export.formats:
+            raise AdminCommandError("Unknown export format %s. Use one "
+                                    "of %s." % (format, 
+                                    ", ".join(sorted(export.formats))))
+        filters = {
+            'agreed_by': user or None,
+            'message_name': message or None,
+        }
+        for value, key, offset in ((start, 'start', timedelta(0)),
+                                   (end, 'end', timedelta(days=1))):
+            filters[key] = None
+            if value:
+                try:
+                    date = parse_date(value, utc)
+                except TracError:
+                    raise AdminCommandError("Incorrect format for date. "
+                                            "Should be YYYY-MM-DD")
+                filters[key] = to_utimestamp(date + offset)
+
+        encoder = export.formats[format][1]
+        records = ProjectMessageRecord.iter_records(self.env, **filters)
+        for chunk in encoder(records):
+            sys.stdout.write(chunk)
+
     def _insert_message(self, name, message, button, mode, start, end, *args):
         """
         Inserts a new project message into the project_message table, 
@@ -1,18 +1,28 @@
 # Author: Danny Milsom <danny.milsom@cgi.com>
 # Copyright (C) 2014 CGI IT UK Ltd
 
-from trac.config import ListOption
+from threading import Lock
+import time
+
+from trac.config import BoolOption, IntOption, ListOption
 from trac.core import Component, TracError, implements
-from trac.db import Table, Column, DatabaseManager
+from trac.db import Table, Column, Index, DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
 from trac.perm import IPermissionRequestor
 from trac.util.translation import _
 
+from projectmessage.cache import LRUCache
+from projectmessage.writer import RecordWriter
+
 
 class ProjectMessageSystem(Component):
     """
-    Creates the project_message and project_message_report tables, and defines 
-    new permission actions applicable to this plugin.
+    Creates the project_message, project_message_record, 
+    project_message_group, project_message_stats, project_message_pending, 
+    project_message_fanout and project_message_generation tables, and 
+    defines new permission actions applicable to this plugin. It also 
+    holds the caches of this process, and keeps them coherent with 
+    changes made by other processes.
     """
 
     implements(IEnvironmentSetupParticipant, IPermissionRequestor)
@@ -20,6 +30,160 @@ class ProjectMessageSystem(Component):
     mode_options = ListOption('projectmessage', 'modes', 
                     ['Alert', 'Full Screen'])
 
+    pending_cache_size = IntOption('projectmessage', 'pending_cache_size',
+                    5000, doc="Maximum number of users whose pending "
+                              "project messages and records are cached in "
+                              "each process.")
+
+    pending_cache_ttl = IntOption('projectmessage', 'pending_cache_ttl', 60,
+                    doc="Number of seconds the pending project messages "
+                        "and records of a user are cached for.")
+
+    membership_cache_size = IntOption('projectmessage', 
+                    'membership_cache_size', 5000,
+                    doc="Maximum number of users whose group memberships "
+                        "are cached in each process.")
+
+    membership_cache_ttl = IntOption('projectmessage', 
+                    'membership_cache_ttl', 300,
+                    doc="""Number of seconds the group memberships of a user 
+                    are cached for. Changes to group membership take up to 
+                    this long to affect which project messages are shown.""")
+
+    write_behind = BoolOption('projectmessage', 'write_behind', False,
+                    doc="""If enabled, records of users agreeing to project 
+                    messages are queued and written to the database in 
+                    batches by a background thread, rather than during the 
+                    request.""")
+
+    write_behind_batch_size = IntOption('projectmessage', 
+                    'write_behind_batch_size', 100,
+                    doc="Number of queued records which are written at once.")
+
+    write_behind_interval = IntOption('projectmessage', 
+                    'write_behind_interval', 5,
+                    doc="""Maximum number of seconds a record is queued 
+                    before it is written.""")
+
+    generation_poll_interval = IntOption('projectmessage', 
+                    'generation_poll_interval', 1,
+                    doc="""Minimum number of seconds between each check, 
+                    in each process, for project messages, records and 
+                    group memberships changed by other processes.""")
+
+    # how far before the newest generation seen changes are looked for, to 
+    # allow for transactions which committed late and for clock differences
+    _generation_skew = 5 * 1000000
+
+    # scopes which always have a generation row
+    _generation_scopes = ['messages', 'groups']
+
+    def __init__(self):
+        self.pending_cache = LRUCache(self.pending_cache_size,
+                                      self.pending_cache_ttl)
+        self.record_cache = LRUCache(self.pending_cache_size,
+                                     self.pending_cache_ttl)
+        self.membership_cache = LRUCache(self.membership_cache_size,
+                                         self.membership_cache_ttl)
+        self.record_writer = RecordWriter(self.env, 
+                                          self.write_behind_batch_size,
+                                          self.write_behind_interval)
+        # see ProjectMessage._get_message_rows()
+        self.message_rows = None
+        # see ProjectMessage._get_message_index()
+        self.message_index = None
+        self._generation_lock = Lock()
+        self._generations_polled_at = None
+        self._generations_seen = {}
+        self._generation_max = None
+
+    def invalidate(self, scope):
+        """
+        Discards the data cached by this process for a scope. The scope is 
+        one of 'messages', 'groups', 'records:<username>' or 
+        'groups:<username>'.
+        """
+
+        kind, _, username = scope.partition(':')
+        if kind == 'messages':
+            self.message_rows = None
+            self.pending_cache.clear()
+        elif kind == 'records':
+            self.record_cache.discard(username)
+            self.pending_cache.discard(username)
+        elif kind == 'groups' and username:
+            self.membership_cache.discard(username)
+            self.pending_cache.discard(username)
+        elif kind == 'groups':
+            self.membership_cache.clear()
+            self.pending_cache.clear()
+
+    def bump_generations(self, db, scopes):
+        """
+        Advances the generation of each scope, as part of the transaction 
+        making the change, so every process discards its cached copies 
+        when it next polls for changes. Callers should invalidate the 
+        scopes in this process once the change is committed.
+
+        Each scope has a single row. Its generation is the time of the 
+        latest change in microseconds, or one more than the previous 
+        generation if that is later, so it changes with every bump.
+        """
+
+        now = int(time.time() * 1000000)
+        cursor = db.cursor()
+        for scope in scopes:
+            cursor.execute("""UPDATE project_message_generation
+                              SET generation=CASE WHEN generation < %s 
+                                                  THEN %s 
+                                                  ELSE generation + 1 END
+                              WHERE scope=%s""", (now, now, scope))
+            if cursor.rowcount == 0:
+                cursor.execute("""INSERT INTO project_message_generation 
+                                    (scope, generation)
+                                  VALUES (%s, %s)""", (scope, now))
+
+    def poll_generations(self):
+        """
+        Invalidates the scopes changed by other processes since the last 
+        check. Changes are only checked for once per 
+        generation_poll_interval, so this is cheap to call before each 
+        read of a cache.
+
+        Only the scopes whose generation is newer than the newest one seen 
+        by the last check, less a few seconds for late commits, are read.
+        """
+
+        now = time.time()
+        with self._generation_lock:
+            polled_at = self._generations_polled_at
+            if (polled_at is not None and 
+                now < polled_at + self.generation_poll_interval):
+                return
+            self._generations_polled_at = now
+
+            since = self._generation_max
+            if since is None:
+                since = int(now * 1000000)
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""SELECT scope, generation
+                              FROM project_message_generation
+                              WHERE generation > %s""", 
+                           (since - self._generation_skew,))
+            # scopes changed within the skew are read by more than one 
+            # check, but only invalidate the caches once
+            seen = dict(cursor)
+            for scope, generation in seen.iteritems():
+                if self._generations_seen.get(scope) != generation:
+                    self.log.debug("Project message scope %s changed", scope)
+                    self.invalidate(scope)
+            self._generations_seen = seen
+            if seen:
+                self._generation_max = max(since, max(seen.itervalues()))
+            else:
+                self._generation_max = since
+
     # IPermissionRequestor method
 
     def get_permission_actions(self):
@@ -29,7 +193,7 @@ class ProjectMessageSystem(Component):
 
     # IEnvironmentSetupParticipant
 
-    _schema_version = 2
+    _schema_version = 10
     schema = [
         Table('project_message')[
             Column('name'),
@@ -41,13 +205,42 @@ class ProjectMessageSystem(Component):
             Column('end', type='int64'),
             Column('author'),
             Column('created_at', type='int64'),
+            Index(['name'], unique=True),
             ],
         Table('project_message_record')[
             Column('record_id', auto_increment=True),
             Column('message_name'),
             Column('agreed_by'),
             Column('agreed_at', type='int64'),
-            ]
+            Index(['agreed_by', 'message_name'], unique=True),
+            Index(['agreed_at']),
+            ],
+        Table('project_message_group', key=('message_name', 'group_name'))[
+            Column('message_name'),
+            Column('group_name'),
+            Index(['group_name']),
+            ],
+        Table('project_message_stats', key='message_name')[
+            Column('message_name'),
+            Column('targeted', type='int'),
+            Column('agreed', type='int'),
+            ],
+        Table('project_message_pending', key=('username', 'message_name'))[
+            Column('username'),
+            Column('message_name'),
+            Column('mode'),
+            Index(['message_name']),
+            ],
+        Table('project_message_fanout', key='username')[
+            Column('username'),
+            Column('groups'),
+            Column('fanned_out_at', type='int64'),
+            ],
+        Table('project_message_generation', key='scope')[
+            Column('scope'),
+            Column('generation', type='int64'),
+            Index(['generation']),
+            ],
         ]
 
     def environment_created(self):
@@ -62,6 +255,10 @@ class ProjectMessageSystem(Component):
             cursor.execute("""INSERT INTO system (name, value) 
                               VALUES ('projectmessage_schema', %s)""", 
                            (str(self._schema_version),))
+            cursor.executemany("""INSERT INTO project_message_generation 
+                                    (scope, generation)
+                                  VALUES (%s, 0)""", 
+                               [(scope,) for scope in self._generation_scopes])
 
     def _check_schema_version(self, db):
         cursor = db.cursor()
@@ -0,0 +1,58 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+from collections import OrderedDict
+from threading import RLock
+import time
+
+
+class LRUCache(object):
+    """
+    A small thread safe mapping which holds at most max_size entries,
+    discarding the least recently used entry when full.
+
+    If a ttl (in seconds) is given, entries older than ttl are treated as
+    missing and removed on access. This cache is local to the process, so
+    the ttl also bounds how stale an entry can be when another process
+    changes the database.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            # re-insert so the key becomes the most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
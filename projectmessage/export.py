@@ -0,0 +1,62 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+from cStringIO import StringIO
+import csv
+import json
+
+from trac.util.datefmt import from_utimestamp
+
+columns = ['record_id', 'message_name', 'agreed_by', 'agreed_at']
+
+
+def _record_values(record):
+    return [record.record_id, record.message_name, record.agreed_by,
+            from_utimestamp(record.agreed_at).isoformat()]
+
+
+def iter_csv(records, buffer_size=8192):
+    """
+    Yields the records as chunks of UTF-8 encoded CSV, starting with a
+    header row. Each chunk is roughly buffer_size bytes.
+    """
+
+    out = StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for record in records:
+        writer.writerow([unicode(v).encode('utf-8') 
+                         for v in _record_values(record)])
+        if out.tell() >= buffer_size:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+
+def iter_json(records, buffer_size=8192):
+    """
+    Yields the records as chunks of a JSON array of objects. Each chunk 
+    is roughly buffer_size bytes.
+    """
+
+    out = StringIO()
+    out.write('[')
+    separator = '\n'
+    for record in records:
+        out.write(separator)
+        out.write(json.dumps(dict(zip(columns, _record_values(record)))))
+        separator = ',\n'
+        if out.tell() >= buffer_size:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    out.write('\n]\n')
+    yield out.getvalue()
+
+
+# maps each export format to its mimetype and encoder
+formats = {
+    'csv': ('text/csv', iter_csv),
+    'json': ('application/json', iter_json),
+}
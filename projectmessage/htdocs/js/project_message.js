@@ -1,26 +1,27 @@
 $( document ).ready(function() {
 
-  // Listen to full screen agreement
-  $("#project-message-agreement-btn").click(function(e) {
-    e.preventDefault();
+  // Acknowledge every project message in the given forms with one request
+  function agree(forms, success) {
     $.ajax({
       type:"POST",
-      data: $("#project-message-form").serialize(),
+      data: forms.serialize(),
       url: window.tracBaseUrl + "ajax/projectmessage",
-      success: function() {
-        window.location.replace(tracBaseUrl);
-      }
+      success: success
+    });
+  }
+
+  // Listen to full screen agreement
+  $("#project-message-agreement-btn").click(function(e) {
+    e.preventDefault();
+    agree($("#project-message-form"), function() {
+      window.location.replace(tracBaseUrl);
     });
   });
 
   // Listen to alert agreement (via closing the alert box)
   $("button.close", ".project-message").click(function(e){
     e.preventDefault();
-    $.ajax({
-      type:"POST",
-      data: $(this).parent().next("form").serialize(),
-      url: window.tracBaseUrl + "ajax/projectmessage"
-    });
+    agree($(this).parent().next("form"));
   });
 
 });
@@ -1,12 +1,12 @@
 # Author: Danny Milsom <danny.milsom@cgi.com>
 # Copyright (C) 2014 CGI IT UK Ltd
 
+from collections import namedtuple
 from datetime import datetime
 from itertools import izip
 import json
 import pytz
 
-from trac.cache import cached
 from trac.core import TracError
 from trac.resource import ResourceNotFound
 from trac.util.datefmt import from_utimestamp, to_utimestamp, parse_date
@@ -54,24 +54,6 @@ class ProjectMessage(object):
         else:
             raise ResourceNotFound("Project message '%s' does not exist.", (name))
 
-    def _populate_from_database(self, row):
-        """
-        Takes a row returned from a cursor and populates instance 
-        attributes based on these values."""
-
-        (name, message, button, mode, 
-        groups, start, end, author, created_at) = row
-
-        self['name'] = name
-        self['message'] = message
-        self['button'] = button
-        self['mode'] = mode
-        self['groups'] = json.loads(groups) if groups else None
-        self['start'] = from_utimestamp(start)
-        self['end'] = from_utimestamp(end)
-        self['author'] = author
-        self['created_at'] = from_utimestamp(created_at)
-
     def __getitem__(self, key):
         return self.values.get(key)
 
@@ -205,6 +187,11 @@ class ProjectMessage(object):
                 else:
                     args.append(self[key])
 
+            # expanding the groups may be slow, so is done once here rather 
+            # than each time the statistics or pending messages are read
+            targeted = ProjectMessage.get_targeted_users(self.env, 
+                                                         self['groups'])
+
             @self.env.with_transaction()
             def do_insert(db):
                 cursor = db.cursor()
@@ -215,14 +202,31 @@ class ProjectMessage(object):
                                   VALUES (%s, %s, %s, %s, %s, 
                                     %s, %s, %s, %s)
                                 """, args)
-
-        del self._get_all_messages
+                cursor.executemany("""INSERT INTO project_message_group 
+                                        (message_name, group_name)
+                                      VALUES (%s, %s)""", 
+                                   [(self['name'], group) 
+                                    for group in set(self['groups'])])
+                cursor.execute("""INSERT INTO project_message_stats 
+                                    (message_name, targeted, agreed)
+                                  VALUES (%s, %s, 0)""", 
+                               (self['name'], len(targeted)))
+                cursor.executemany("""INSERT INTO project_message_pending 
+                                        (username, message_name, mode)
+                                      VALUES (%s, %s, %s)""",
+                                   [(username, self['name'], self['mode'])
+                                    for username in targeted])
+                ProjectMessageSystem(self.env).bump_generations(db, 
+                                                                ['messages'])
+
+        ProjectMessageSystem(self.env).invalidate('messages')
 
     def hide(self):
         """
         We do not allow users to delete project messages, but they can be 
         hidden. This will stop the notification appearing in the user 
-        interface, and is represented as a NULL value in the groups column.
+        interface, and is represented as a NULL value in the groups column 
+        and by removing the rows for the message from project_message_group.
         """
 
         @self.env.with_transaction()
@@ -233,35 +237,66 @@ class ProjectMessage(object):
             cursor.execute("""UPDATE project_message
                               SET groups=%s
                               WHERE name=%s""", (None, self['name']))
+            cursor.execute("""DELETE FROM project_message_group
+                              WHERE message_name=%s""", (self['name'],))
+            cursor.execute("""DELETE FROM project_message_pending
+                              WHERE message_name=%s""", (self['name'],))
+            ProjectMessageSystem(self.env).bump_generations(db, ['messages'])
+
+        ProjectMessageSystem(self.env).invalidate('messages')
 
     @classmethod
     def get_all_messages(cls, env):
         """
         Returns all project messages stored in the project_message table, 
-        ordered by the creation timestamp.
+        ordered by the creation timestamp, as read-only MessageRow objects.
+        """
 
-        This result is cached for performance, but due to the 
-        implementation of the trac cache system, we have to call an instance 
-        method for this to work.
+        return list(ProjectMessage._get_message_rows(env))
+
+    @classmethod
+    def _get_message_rows(cls, env):
         """
+        Returns a tuple of MessageRow objects for every project message.
 
-        result = []
-        for row in ProjectMessage(env)._get_all_messages:
-            msg = ProjectMessage(env)
-            msg._populate_from_database(row)
-            result.append(msg)
-        return result
+        The rows are cached by the ProjectMessageSystem component, and 
+        are only reloaded after the messages scope is invalidated, by a 
+        change in this process or another.
+        """
 
-    @cached
-    def _get_all_messages(self, db):
+        system = ProjectMessageSystem(env)
+        system.poll_generations()
+        rows = system.message_rows
+        if rows is None:
+            db = env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""SELECT name, message, button, mode, groups, 
+                                     start, "end", author, created_at
+                              FROM project_message
+                              ORDER BY created_at""")
+            rows = system.message_rows = tuple(MessageRow.from_db(row) 
+                                               for row in cursor)
+        return rows
+
+    @classmethod
+    def _get_message_index(cls, env):
+        """
+        Returns a MessageIndex of the currently active messages.
+
+        The index is kept by the ProjectMessageSystem component, and is 
+        only rebuilt from the cached rows when they are reloaded or when 
+        a message starts or ends. As the set of active messages changes 
+        at those points, the pending message cache is cleared too.
         """
-        Cache is invalidated after an insert into the project_message table."""
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, message, button, mode, groups, 
-                                 start, "end", author, created_at
-                          FROM project_message
-                          ORDER BY created_at""")
-        return cursor.fetchall()
+
+        rows = ProjectMessage._get_message_rows(env)
+        now = to_utimestamp(datetime.now(pytz.utc))
+        system = ProjectMessageSystem(env)
+        index = system.message_index
+        if index is None or index.rows is not rows or index.expired(now):
+            index = system.message_index = MessageIndex(rows, now)
+            system.pending_cache.clear()
+        return index
 
     @classmethod
     def get_filtered_messages(cls, env, username=None):
@@ -275,45 +310,154 @@ class ProjectMessage(object):
         filter the messages accordingly too.
         """
 
-        all_msgs = ProjectMessage.get_all_messages(env)
-        today = datetime.now(pytz.utc)
-        filtered_msgs = [msg for msg in all_msgs
-                         if msg['start'] <= today < msg['end'] and
-                         msg['groups'] is not None]
-
+        user_groups = None
         if username is not None:
+            user_groups = ProjectMessage.get_group_memberships(env, 
+                                                               username)
+            user_groups = list(user_groups) + ["*"]
+
+        return ProjectMessage._get_message_index(env).active_rows(user_groups)
+
+    @classmethod
+    def get_last_published(cls, env):
+        """
+        Returns the microsecond timestamp at which the most recent of the 
+        currently active messages was created or started, or 0 if there 
+        are no active messages.
+        """
+
+        return ProjectMessage._get_message_index(env).last_published
+
+    @classmethod
+    def get_targeted_users(cls, env, groups):
+        """
+        Returns a list of the known users who are a member of at least one 
+        of the groups, or of every known user if the groups include "*".
+
+        Trac only stores a session for users whose session holds data, so 
+        the known users are those with an authenticated session, those 
+        whose pending messages have been fanned out, and those who have 
+        agreed to a message. Every user who may already have been fanned 
+        out is included, as they are not fanned out again until their 
+        groups change.
+        """
+
+        groups = set(groups)
+        db = env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""SELECT sid
+                          FROM session
+                          WHERE authenticated=1
+                          UNION
+                          SELECT username
+                          FROM project_message_fanout
+                          UNION
+                          SELECT agreed_by
+                          FROM project_message_record""")
+        usernames = [sid for sid, in cursor]
+        if "*" in groups:
+            return usernames
+
+        memberships = ProjectMessage.get_group_memberships_many(env, 
+                                                                usernames)
+        return [username for username in usernames
+                if groups.intersection(memberships[username])]
+
+    @classmethod
+    def get_group_memberships(cls, env, username):
+        """
+        Returns a frozenset of the groups the user is a member of.
+
+        Resolving memberships can be expensive, so they are cached per 
+        user by the ProjectMessageSystem component, for up to the 
+        membership_cache_ttl option.
+        """
+
+        system = ProjectMessageSystem(env)
+        system.poll_generations()
+        groups = system.membership_cache.get(username)
+        if groups is None:
             sp = SimplifiedPermissions(env)
-            user_groups = sp.group_memberships_for_user(username) + ["*"]
-            filtered_msgs = [msg for msg in filtered_msgs
-                                        if any(group in msg['groups'] 
-                                            for group in user_groups)]
+            groups = frozenset(sp.group_memberships_for_user(username))
+            system.membership_cache.set(username, groups)
+        return groups
+
+    @classmethod
+    def get_group_memberships_many(cls, env, usernames):
+        """
+        Returns a dictionary mapping each of the usernames to a frozenset 
+        of the groups that user is a member of.
+
+        Cached memberships are used where available. The rest are resolved 
+        one user at a time, as that is all SimplifiedPermissions offers, 
+        and are not cached - this is used to expand the groups of every 
+        known user, which would evict the memberships of the users making 
+        requests.
+        """
+
+        system = ProjectMessageSystem(env)
+        system.poll_generations()
+        cache = system.membership_cache
+        sp = SimplifiedPermissions(env)
+        memberships = {}
+        for username in set(usernames):
+            groups = cache.get(username)
+            if groups is None:
+                groups = frozenset(sp.group_memberships_for_user(username))
+            memberships[username] = groups
+        return memberships
+
+    @classmethod
+    def invalidate_group_memberships(cls, env, usernames=None):
+        """
+        Discards the cached group memberships of the users, or of every 
+        user if no usernames are given, along with their pending messages 
+        which depend on them, in every process, so their pending messages 
+        are fanned out again.
+
+        This should be called whenever group memberships are changed, as 
+        SimplifiedPermissions does not announce such changes.
+        """
+
+        if usernames is None:
+            scopes = ['groups']
+        else:
+            scopes = ['groups:%s' % username for username in usernames]
+
+        # users added to a group need the group's messages fanned out to 
+        # them again, which happens the next time they are looked up
+        system = ProjectMessageSystem(env)
+        @env.with_transaction()
+        def do_delete(db):
+            cursor = db.cursor()
+            if usernames is None:
+                cursor.execute("DELETE FROM project_message_fanout")
+            else:
+                cursor.executemany("""DELETE FROM project_message_fanout
+                                      WHERE username=%s""",
+                                   [(username,) for username in usernames])
+            system.bump_generations(db, scopes)
 
-        return filtered_msgs
+        for scope in scopes:
+            system.invalidate(scope)
 
     @classmethod
-    def get_agreed_messages(cls, env, user):
+    def get_message_stats(cls, env):
         """
-        Returns a list of all project messages the specified user has 
-        acknowledged, ordered by agreement date.
+        Returns a dictionary mapping the name of each project message to 
+        a (targeted, agreed) tuple; the number of users the message was 
+        published to, and the number of users who have agreed to it.
+
+        The counts are maintained as messages are created and agreed to, 
+        so no records are counted here.
         """
 
         db = env.get_read_db()
         cursor = db.cursor()
-        cursor.execute("""SELECT m.name, m.message, m.button, m.mode,
-                                 m.groups, m.start, m."end",
-                                 m.author, m.created_at
-                          FROM project_message as m
-                          JOIN project_message_record as r
-                            ON m.name = r.message_name
-                          WHERE r.agreed_by=%s
-                          ORDER BY r.agreed_at""", (user,))
-
-        result = []
-        for row in cursor.fetchall():
-            msg = ProjectMessage(env)
-            msg._populate_from_database(row)
-            result.append(msg)
-        return result
+        cursor.execute("""SELECT message_name, targeted, agreed
+                          FROM project_message_stats""")
+        return dict((name, (targeted, agreed)) 
+                    for name, targeted, agreed in cursor)
 
     @classmethod
     def get_unagreed_messages(cls, env, username, mode=None):
@@ -327,18 +471,314 @@ class ProjectMessage(object):
 
         The returned results also respect any membership group and date 
         filters set, as we call get_filtered_messages().
+
+        The names of the pending messages are read from the 
+        project_message_pending table, which is filled when messages are 
+        created, and are cached per user. The date filter is applied 
+        again as cached messages may have since expired.
+        """
+
+        system = ProjectMessageSystem(env)
+        system.poll_generations()
+        cache = system.pending_cache
+        pending = cache.get(username)
+        if pending is None:
+            pending = cls._get_pending_names(env, username)
+            cache.set(username, pending)
+
+        current = dict((m['name'], m) 
+                        for m in ProjectMessage.get_filtered_messages(env))
+        return [current[name] for name in pending.get(mode, ())
+                if name in current]
+
+    @classmethod
+    def _get_pending_names(cls, env, username):
+        """
+        Returns a dictionary mapping each mode to a tuple of the names of 
+        messages the user has not agreed to. The None key holds the names 
+        of all unagreed messages regardless of mode.
+
+        The names are read from the project_message_pending table with a 
+        single query on its primary key. The user's messages are fanned 
+        out first if that has not been done, or if their groups have 
+        changed since it was. They are then filtered by the user's current 
+        groups, as the user may have left a group since.
+
+        Agreements still queued by the record writer count as agreed.
+        """
+
+        db = env.get_read_db()
+        cursor = db.cursor()
+        # the second select returns the groups the user was fanned out for
+        cursor.execute("""SELECT message_name, NULL
+                          FROM project_message_pending
+                          WHERE username=%s
+                          UNION ALL
+                          SELECT NULL, groups
+                          FROM project_message_fanout
+                          WHERE username=%s""", (username, username))
+        names = set()
+        fanned_out_groups = None
+        for name, groups in cursor:
+            if name is None:
+                fanned_out_groups = groups
+            else:
+                names.add(name)
+        groups = ProjectMessage.get_group_memberships(env, username)
+        if fanned_out_groups != _encode_groups(groups):
+            names = ProjectMessage.fan_out_user(env, username)
+        names.difference_update(
+            ProjectMessageSystem(env).record_writer.queued_names(username))
+
+        pending = {None: []}
+        for m in ProjectMessage.get_filtered_messages(env, username):
+            if m['name'] in names:
+                pending[None].append(m['name'])
+                pending.setdefault(m['mode'], []).append(m['name'])
+        return dict((k, tuple(v)) for k, v in pending.iteritems())
+
+    @classmethod
+    def get_unagreed_message_names(cls, env, username, mode=None, 
+                                   upcoming=False):
+        """
+        Returns a list of (name, mode) tuples of the active messages 
+        targeted at the user's groups which the user has not agreed to, 
+        ordered by creation date.
+
+        The date window, hidden flag, mode, groups and agreement are all 
+        checked by a single query, so only the pending messages are read. 
+        If upcoming is True, messages which have not started yet are 
+        included too.
+        """
+
+        groups = ProjectMessage.get_group_memberships(env, username)
+        groups = sorted(groups.union(["*"]))
+        now = to_utimestamp(datetime.now(pytz.utc))
+
+        where = ['m."end" > %s']
+        args = [now]
+        if not upcoming:
+            where.append("m.start <= %s")
+            args.append(now)
+        if mode is not None:
+            where.append("m.mode=%s")
+            args.append(mode)
+        args.extend(groups)
+        args.append(username)
+
+        db = env.get_read_db()
+        cursor = db.cursor()
+        # hidden messages have no project_message_group rows
+        cursor.execute("""SELECT m.name, m.mode
+                          FROM project_message AS m
+                          WHERE %s
+                            AND EXISTS (SELECT * 
+                                        FROM project_message_group AS g
+                                        WHERE g.message_name=m.name
+                                          AND g.group_name IN (%s))
+                            AND NOT EXISTS (SELECT * 
+                                            FROM project_message_record AS r
+                                            WHERE r.agreed_by=%%s
+                                              AND r.message_name=m.name)
+                          ORDER BY m.created_at
+                          """ % (" AND ".join(where), 
+                                 ",".join(["%s"] * len(groups))), args)
+        return cursor.fetchall()
+
+    @classmethod
+    def fan_out_user(cls, env, username):
+        """
+        Adds a project_message_pending row for each visible, unexpired 
+        message the user is targeted by and has not agreed to, and returns 
+        the set of their names.
+
+        Messages are fanned out to existing users when they are created, 
+        so this is only needed for each user who was not known then, and 
+        again whenever their groups change. The groups the user was fanned 
+        out for are stored in project_message_fanout. Existing pending rows 
+        are kept, as they may have been added by a message created 
+        concurrently.
+        """
+
+        now = to_utimestamp(datetime.now(pytz.utc))
+        groups = ProjectMessage.get_group_memberships(env, username)
+        messages = ProjectMessage.get_unagreed_message_names(env, username, 
+                                                             upcoming=True)
+
+        def add_rows():
+            @env.with_transaction()
+            def do_insert(db):
+                cursor = db.cursor()
+                cursor.executemany("""
+                    INSERT INTO project_message_pending 
+                        (username, message_name, mode)
+                    SELECT %s, %s, %s
+                    WHERE NOT EXISTS (SELECT * FROM project_message_pending
+                                      WHERE username=%s AND message_name=%s)
+                    """, [(username, name, mode, username, name) 
+                          for name, mode in messages])
+                cursor.execute("""DELETE FROM project_message_fanout
+                                  WHERE username=%s""", (username,))
+                cursor.execute("""INSERT INTO project_message_fanout 
+                                    (username, groups, fanned_out_at)
+                                  VALUES (%s, %s, %s)""", 
+                               (username, _encode_groups(groups), now))
+
+        try:
+            add_rows()
+        except env.db_exc.IntegrityError:
+            # a concurrent request fanned out the user between our checks 
+            # and inserts - try again, skipping the rows it added
+            add_rows()
+        env.log.debug("Fanned out %d project messages to %s", 
+                      len(messages), username)
+
+        return set(name for name, mode in messages)
+
+
+def _encode_groups(groups):
+    """
+    Returns the groups as a JSON list, in the form they are stored in 
+    project_message_fanout.
+    """
+
+    return json.dumps(sorted(groups))
+
+
+class MessageRow(namedtuple('MessageRow', ProjectMessage.message_keys)):
+    """
+    A read-only project message, as loaded from the project_message table.
+
+    Rows are immutable so they can be cached and shared between requests. 
+    Values can be read by attribute or by key - the start, end and 
+    created_at attributes hold microsecond timestamps, while accessing 
+    them by key returns a datetime, for compatibility with ProjectMessage.
+
+    The groups attribute is a frozenset, decoded from JSON once when the 
+    row is loaded, or None if the message is hidden. Accessing it by key 
+    returns a sorted list.
+    """
+
+    __slots__ = ()
+
+    timestamp_keys = frozenset(['start', 'end', 'created_at'])
+
+    @classmethod
+    def from_db(cls, row):
+        """Returns a new MessageRow from a project_message cursor row."""
+
+        (name, message, button, mode, 
+        groups, start, end, author, created_at) = row
+        groups = frozenset(json.loads(groups)) if groups else None
+        return cls(name, message, button, mode, 
+                   groups, start, end, author, created_at)
+
+    def __getitem__(self, key):
+        if not isinstance(key, basestring):
+            return tuple.__getitem__(self, key)
+        if key not in self._fields:
+            return None
+        value = getattr(self, key)
+        if key in self.timestamp_keys:
+            return from_utimestamp(value)
+        if key == 'groups':
+            return sorted(value) if value is not None else None
+        return value
+
+
+class MessageIndex(object):
+    """
+    An in-memory index of the project messages active at a point in time.
+
+    Hidden messages, and messages outside of their start and end dates, 
+    are left out. The active messages are bucketed by group (including 
+    the "*" group), so finding the messages shown to a user is a union of 
+    the buckets for that user's groups rather than a scan of every message 
+    ever created.
+
+    The index also records the next time a message starts or ends. Until 
+    then the index remains correct, so checking whether it needs to be 
+    rebuilt is a single timestamp comparison. The time the most recent 
+    active message was published (created or started) is kept in 
+    last_published.
+
+    The index holds positions in the rows tuple, so results keep the 
+    creation order of the rows.
+    """
+
+    def __init__(self, rows, now):
+        self.rows = rows
+        self.by_group = {}
+        self.next_boundary = None
+        self.last_published = 0
+        for pos, row in enumerate(rows):
+            groups, start, end = row.groups, row.start or 0, row.end or 0
+            if groups is None or end <= now or end <= start:
+                continue
+            boundary = start if start > now else end
+            if self.next_boundary is None or boundary < self.next_boundary:
+                self.next_boundary = boundary
+            if start <= now:
+                for group in groups:
+                    self.by_group.setdefault(group, []).append(pos)
+                self.last_published = max(self.last_published, start, 
+                                          row.created_at or 0)
+
+    def expired(self, now):
+        """
+        Returns True if a message has started or ended since the index 
+        was built.
+        """
+
+        return self.next_boundary is not None and now >= self.next_boundary
+
+    def active_rows(self, groups=None):
+        """
+        Returns the rows of active messages shown to at least one of the 
+        groups passed. If groups is None, all active messages are returned.
         """
 
-        if mode:
-            all_msgs = [m for m in ProjectMessage.get_filtered_messages(env, username) 
-                            if m['mode'] == mode]
+        if groups is None:
+            buckets = self.by_group.values()
         else:
-            all_msgs = [m for m in ProjectMessage.get_filtered_messages(env, username)]
+            buckets = [self.by_group[g] for g in set(groups) 
+                       if g in self.by_group]
+
+        matches = set()
+        for bucket in buckets:
+            matches.update(bucket)
+        return [self.rows[pos] for pos in sorted(matches)]
+
+
+class UnagreedMessages(object):
+    """
+    The project messages a user has not agreed to, grouped by mode.
+
+    This is used to share the result of a single lookup between the 
+    different request hooks which show project messages.
+    """
 
-        agreed_msgs = [m['name'] for m in ProjectMessage.get_agreed_messages(env, username)]
-        unseen = set(m['name'] for m in all_msgs) - set(agreed_msgs)
+    def __init__(self, messages):
+        self.messages = messages
+        self.by_mode = {}
+        for m in messages:
+            self.by_mode.setdefault(m['mode'], []).append(m)
 
-        return [m for m in all_msgs if m['name'] in unseen]
+    def get(self, mode=None):
+        """
+        Returns the unagreed messages with the specified mode, or all 
+        unagreed messages if mode is None.
+        """
+
+        if mode is None:
+            return self.messages
+        return self.by_mode.get(mode, [])
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
 
 
 class ProjectMessageRecord(object):
@@ -379,19 +819,6 @@ class ProjectMessageRecord(object):
             raise ResourceNotFound("Project message record '%s' does "
                                    "not exist.", (record_id))
 
-    def _populate_from_database(self, row):
-        """
-        Takes a row returned from a cursor and populates instance 
-        attributes based on these values.
-        """
-
-        (record_id, name, user, agreed_at) = row
-
-        self['record_id'] = record_id
-        self['message_name'] = name
-        self['agreed_by'] = user
-        self['agreed_at'] = from_utimestamp(agreed_at)
-
     def __getitem__(self, key):
         return self.values.get(key)
 
@@ -413,62 +840,260 @@ class ProjectMessageRecord(object):
         the details surrounding the acknowledgement of any message.
         """
 
-        @self.env.with_transaction()
-        def add_record(db):
-            args = []
-            for key in [k for k in self.record_keys if k != 'record_id']:
-                args.append(self[key])
-            cursor = db.cursor()
-            cursor.execute("""INSERT into project_message_record(message_name, agreed_by, agreed_at) 
-                              VALUES (%s, %s, %s)""", args)
+        ProjectMessageRecord.insert_many(self.env, [self['message_name']], 
+                                         self['agreed_by'], self['agreed_at'])
 
-        del self._get_all_records
+    @classmethod
+    def insert_many(cls, env, names, username, agreed_at=None):
+        """
+        Inserts a row into the project_message_record table for each of the 
+        message names passed, to record that the user agreed to them.
+
+        All rows are written in a single transaction, and caches are only 
+        invalidated once. If agreed_at is None the current time is used.
+
+        Acknowledgements are idempotent - if the user has already agreed 
+        to a message, no new row is written for it.
+        """
+
+        if agreed_at is None:
+            agreed_at = to_utimestamp(datetime.now(pytz.utc))
+        ProjectMessageRecord.write_records(env, [(name, username, agreed_at) 
+                                                 for name in names])
 
     @classmethod
-    def get_all_records(cls, env):
+    def write_records(cls, env, records):
         """
-        Returns a list of all records, detailing the messages acknowledged 
-        by each user. For convenience this is sorted by agreement date, 
-        and cached for performance.
+        Inserts (message_name, agreed_by, agreed_at) tuples into the 
+        project_message_record table in a single transaction, skipping 
+        any message a user has already agreed to.
+        """
+
+        seen = set()
+        args = []
+        for name, username, agreed_at in records:
+            if (name, username) not in seen:
+                seen.add((name, username))
+                args.append((name, username, agreed_at, name, username))
+        if not args:
+            return
+
+        def add_records():
+            @env.with_transaction()
+            def do_insert(db):
+                cursor = db.cursor()
+                # each record is inserted by its own statement so the row 
+                # count tells us whether it was new, which the statistics 
+                # of the message are then updated with
+                agreed = {}
+                for row in args:
+                    cursor.execute("""
+                        INSERT INTO project_message_record 
+                            (message_name, agreed_by, agreed_at)
+                        SELECT %s, %s, %s
+                        WHERE NOT EXISTS (SELECT * FROM project_message_record
+                                          WHERE message_name=%s 
+                                            AND agreed_by=%s)
+                        """, row)
+                    if cursor.rowcount > 0:
+                        agreed[row[0]] = agreed.get(row[0], 0) + 1
+                cursor.executemany("""UPDATE project_message_stats
+                                      SET agreed=agreed + %s
+                                      WHERE message_name=%s""",
+                                   [(count, name) 
+                                    for name, count in agreed.iteritems()])
+                cursor.executemany("""DELETE FROM project_message_pending
+                                      WHERE username=%s 
+                                        AND message_name=%s""",
+                                   [(username, name) 
+                                    for name, username in seen])
+                system.bump_generations(db, scopes)
+
+        # only the caches of the users who agreed are affected
+        system = ProjectMessageSystem(env)
+        scopes = sorted(set('records:%s' % username 
+                            for name, username in seen))
+        try:
+            add_records()
+        except env.db_exc.IntegrityError:
+            # a concurrent request inserted one of the records between our 
+            # check and insert - try again, skipping the existing records
+            add_records()
+
+        for scope in scopes:
+            system.invalidate(scope)
+
+    @classmethod
+    def agree(cls, env, names, username):
         """
+        Records that the user agreed to the named messages.
+
+        If the write_behind option is enabled, the records are queued and 
+        written in batches by a background thread, and the user's cached 
+        pending messages are updated straight away so they are not shown 
+        the messages again. Otherwise the records are inserted immediately.
+        """
+
+        system = ProjectMessageSystem(env)
+        if not system.write_behind:
+            return ProjectMessageRecord.insert_many(env, names, username)
 
-        result = []
-        for row in ProjectMessageRecord(env)._get_all_records:
-            record = ProjectMessageRecord(env)
-            record._populate_from_database(row)
-            result.append(record)
-        return result
+        agreed_at = to_utimestamp(datetime.now(pytz.utc))
+        system.record_writer.put([(name, username, agreed_at) 
+                                  for name in names])
+        pending = system.pending_cache.get(username)
+        if pending is not None:
+            names = set(names)
+            system.pending_cache.set(username, dict(
+                (mode, tuple(n for n in pending_names if n not in names))
+                for mode, pending_names in pending.iteritems()))
 
-    @cached
-    def _get_all_records(self, db):
+    @classmethod
+    def get_all_records(cls, env):
         """
-        Cache is invalidated after an insert into the project_message_records 
-        table.
+        Returns a list of all records, detailing the messages acknowledged 
+        by each user. For convenience this is sorted by agreement date.
+
+        This is not cached, as it is only used for auditing and the table 
+        grows with every acknowledgement.
         """
 
+        db = env.get_read_db()
         cursor = db.cursor()
         cursor.execute("""SELECT record_id, message_name, agreed_by, agreed_at
                           FROM project_message_record
                           ORDER BY agreed_at""")
-        return cursor.fetchall()
+        return [RecordRow._make(row) for row in cursor]
 
     @classmethod
-    def get_user_records(cls, env, username):
+    def get_records_page(cls, env, limit, after=None, descending=False,
+                         message_name=None, agreed_by=None, 
+                         start=None, end=None):
         """
-        Returns a list of all message that the specified user has acknowledged.
-        For convenience the result is ordered by agreement date.
+        Returns a page of at most limit records ordered by agreement date 
+        and record id, along with the key of the next page.
+
+        Pages are found by keyset pagination - after is the key returned 
+        with the previous page, or None for the first page. The key of the 
+        next page is None if there are no more records.
+
+        The records can be filtered by message name, user, and a range of 
+        agreement dates (start inclusive, end exclusive, as microsecond 
+        timestamps). Filtering and sorting are done by the database, so 
+        only the rows of a single page are read.
         """
 
+        where, args = cls._get_record_filters(message_name, agreed_by, 
+                                              start, end)
+        op, order = ('<', 'DESC') if descending else ('>', 'ASC')
+        if after is not None:
+            where.append("(agreed_at %s %%s OR "
+                         "(agreed_at=%%s AND record_id %s %%s))" % (op, op))
+            args.extend([after[0], after[0], after[1]])
+
         db = env.get_read_db()
         cursor = db.cursor()
         cursor.execute("""SELECT record_id, message_name, agreed_by, agreed_at
                           FROM project_message_record
-                          WHERE agreed_by=%s
-                          ORDER BY agreed_at""", (username,))
-
-        result = []
-        for row in cursor.fetchall():
-            record = ProjectMessageRecord(env)
-            record._populate_from_database(row)
-            result.append(record)
-        return result
\ No newline at end of file
+                          %s
+                          ORDER BY agreed_at %s, record_id %s
+                          LIMIT %%s""" % (cls._where_clause(where), 
+                                          order, order), 
+                       args + [limit + 1])
+        records = [RecordRow._make(row) for row in cursor]
+
+        next_key = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_key = (records[-1].agreed_at, records[-1].record_id)
+        return records, next_key
+
+    @classmethod
+    def iter_records(cls, env, chunk_size=1000, **filters):
+        """
+        Yields every record matching the filters accepted by 
+        get_records_page(), ordered by agreement date and record id.
+
+        Records are read a page of chunk_size rows at a time, so memory 
+        use does not grow with the size of the table.
+        """
+
+        after = None
+        while True:
+            records, after = cls.get_records_page(env, chunk_size, after, 
+                                                  **filters)
+            for record in records:
+                yield record
+            if after is None:
+                return
+
+    @classmethod
+    def _get_record_filters(cls, message_name=None, agreed_by=None, 
+                            start=None, end=None):
+        """
+        Returns a list of SQL conditions and a list of their arguments, 
+        for filtering the project_message_record table.
+        """
+
+        where = []
+        args = []
+        for condition, value in (("message_name=%s", message_name),
+                                 ("agreed_by=%s", agreed_by),
+                                 ("agreed_at>=%s", start),
+                                 ("agreed_at<%s", end)):
+            if value is not None:
+                where.append(condition)
+                args.append(value)
+        return where, args
+
+    @classmethod
+    def _where_clause(cls, where):
+        return "WHERE " + " AND ".join(where) if where else ""
+
+    @classmethod
+    def get_user_records(cls, env, username):
+        """
+        Returns a list of all message that the specified user has acknowledged.
+        For convenience the result is ordered by agreement date.
+
+        The records are cached per user, and the cache entry of a user is 
+        dropped by every process when they agree to another message.
+        """
+
+        system = ProjectMessageSystem(env)
+        system.poll_generations()
+        cache = system.record_cache
+        records = cache.get(username)
+        if records is None:
+            db = env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""SELECT record_id, message_name, agreed_by, agreed_at
+                              FROM project_message_record
+                              WHERE agreed_by=%s
+                              ORDER BY agreed_at""", (username,))
+            records = tuple(RecordRow._make(row) for row in cursor)
+            cache.set(username, records)
+        return list(records)
+
+
+class RecordRow(namedtuple('RecordRow', ProjectMessageRecord.record_keys)):
+    """
+    A read-only project message record, as loaded from the 
+    project_message_record table.
+
+    Values can be read by attribute or by key - the agreed_at attribute 
+    holds a microsecond timestamp, while accessing it by key returns a 
+    datetime, for compatibility with ProjectMessageRecord.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if not isinstance(key, basestring):
+            return tuple.__getitem__(self, key)
+        if key not in self._fields:
+            return None
+        value = getattr(self, key)
+        if key == 'agreed_at':
+            return from_utimestamp(value)
+        return value
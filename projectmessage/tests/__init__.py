@@ -1,9 +1,11 @@
 import unittest
 
-from projectmessage.tests import model
+from projectmessage.tests import api, cache, model
 
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(api.suite())
+    suite.addTest(cache.suite())
     suite.addTest(model.suite())
     return suite
 
@@ -0,0 +1,87 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+import unittest
+
+from trac.db import DatabaseManager
+from trac.test import EnvironmentStub
+
+from projectmessage.api import ProjectMessageSystem
+from projectmessage.upgrades import db2
+
+
+class ProjectMessageUpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True)
+        self.db = self.env.get_db_cnx()
+        cursor = self.db.cursor()
+        db_connector, _ = DatabaseManager(self.env).get_connector()
+        for table in db2.schema:
+            for statement in db_connector.to_sql(table):
+                cursor.execute(statement)
+        cursor.execute("""INSERT INTO system (name, value) 
+                          VALUES ('projectmessage_schema', '2')""")
+        cursor.executemany("""INSERT INTO project_message (name, message, 
+                                button, mode, groups, start, "end", 
+                                author, created_at)
+                              VALUES (%s, 'Hello World!', 'Agree', 'Alert', 
+                                %s, 1, 2, 'milsomd', %s)""", 
+                           [("Everyone", '["*"]', 1),
+                            ("Managers", '["project_managers"]', 2),
+                            ("Hidden", None, 3)])
+        cursor.executemany("""INSERT INTO project_message_record 
+                                (message_name, agreed_by, agreed_at)
+                              VALUES (%s, %s, %s)""", 
+                           [("Everyone", "milsomd", 1),
+                            ("Everyone", "milsomd", 2),
+                            ("Everyone", "goldinge", 3),
+                            ("Hidden", "doylea", 4)])
+        cursor.executemany("""INSERT INTO session 
+                                (sid, authenticated, last_visit)
+                              VALUES (%s, 1, 0)""", 
+                           [("milsomd",), ("goldinge",), ("clarki",)])
+        self.db.commit()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_upgrade_from_schema_2(self):
+        system = ProjectMessageSystem(self.env)
+        self.assertTrue(system.environment_needs_upgrade(self.db))
+        system.upgrade_environment(self.db)
+        self.assertFalse(system.environment_needs_upgrade(self.db))
+        self.assertEqual(system._schema_version, 
+                         system._check_schema_version(self.db))
+
+        cursor = self.db.cursor()
+        cursor.execute("""SELECT message_name, group_name
+                          FROM project_message_group
+                          ORDER BY message_name""")
+        self.assertEqual([("Everyone", "*"), ("Managers", "project_managers")],
+                         cursor.fetchall())
+        # duplicate records are removed before the unique index is added
+        cursor.execute("""SELECT agreed_by, agreed_at
+                          FROM project_message_record
+                          ORDER BY agreed_at""")
+        self.assertEqual([("milsomd", 1), ("goldinge", 3), ("doylea", 4)], 
+                         cursor.fetchall())
+        cursor.execute("""SELECT message_name, targeted, agreed
+                          FROM project_message_stats
+                          WHERE message_name IN ('Everyone', 'Hidden')
+                          ORDER BY message_name""")
+        # doylea has no session, but is known from their record
+        self.assertEqual([("Everyone", 4, 2), ("Hidden", 0, 1)], 
+                         cursor.fetchall())
+        cursor.execute("""SELECT scope, generation 
+                          FROM project_message_generation
+                          ORDER BY scope""")
+        self.assertEqual([("groups", 0), ("messages", 0)], cursor.fetchall())
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ProjectMessageUpgradeTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,53 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+import time
+import unittest
+
+from projectmessage.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(10)
+        self.assertEqual(None, cache.get('milsomd'))
+        cache.set('milsomd', ('Test Term',))
+        self.assertEqual(('Test Term',), cache.get('milsomd'))
+        self.assertTrue('milsomd' in cache)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.set('milsomd', 1)
+        cache.set('goldinge', 2)
+        cache.get('milsomd')
+        cache.set('clarki', 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get('milsomd'))
+        self.assertEqual(None, cache.get('goldinge'))
+        self.assertEqual(3, cache.get('clarki'))
+
+    def test_expired_entries_are_missing(self):
+        cache = LRUCache(10, ttl=60)
+        cache.set('milsomd', 1)
+        cache._data['milsomd'] = (time.time() - 1, 1)
+        self.assertEqual(None, cache.get('milsomd'))
+        self.assertEqual(0, len(cache))
+
+    def test_discard_and_clear(self):
+        cache = LRUCache(10)
+        cache.set('milsomd', 1)
+        cache.set('goldinge', 2)
+        cache.discard('milsomd')
+        cache.discard('clarki')
+        self.assertEqual(None, cache.get('milsomd'))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LRUCacheTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -10,7 +10,10 @@ from trac.resource import ResourceNotFound
 from trac.test import EnvironmentStub
 from trac.util.datefmt import from_utimestamp, to_utimestamp
 
-from projectmessage.models import ProjectMessage, ProjectMessageRecord
+from projectmessage.models import (MessageIndex, MessageRow, ProjectMessage,
+                                   ProjectMessageRecord, RecordRow,
+                                   UnagreedMessages)
+from projectmessage import export
 from projectmessage.api import ProjectMessageSystem
 from simplifiedpermissionsadminplugin.simplifiedpermissions import SimplifiedPermissions
 
@@ -53,6 +56,152 @@ class ProjectMessageTestCase(unittest.TestCase):
         msg['created_at'] = "1396975221114382"
         return msg
 
+    def test_message_stats(self):
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.executemany("""INSERT INTO session 
+                                    (sid, authenticated, last_visit)
+                                  VALUES (%s, 1, 0)""", 
+                               [("milsomd",), ("goldinge",), ("clarki",)])
+        msg = self._create_new_message()
+        msg['groups'] = ["*"]
+        msg.insert()
+        self.assertEqual({"Test Term": (3, 0)}, 
+                         ProjectMessage.get_message_stats(self.env))
+
+        ProjectMessageRecord.insert_many(self.env, ["Test Term"], "milsomd")
+        ProjectMessageRecord.insert_many(self.env, ["Test Term"], "milsomd")
+        ProjectMessageRecord.insert_many(self.env, ["Test Term"], "goldinge")
+        self.assertEqual({"Test Term": (3, 2)}, 
+                         ProjectMessage.get_message_stats(self.env))
+
+        # users without a session are counted once they are known
+        ProjectMessageRecord.insert_many(self.env, ["Test Term"], "doylea")
+        ProjectMessage.get_unagreed_messages(self.env, "murrayc")
+        second = self._create_new_message()
+        second['name'] = "Another Test Term"
+        second['groups'] = ["*"]
+        second.insert()
+        self.assertEqual((5, 0), ProjectMessage.get_message_stats(
+                                    self.env)["Another Test Term"])
+
+    def test_pending_fan_out(self):
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""INSERT INTO session 
+                                (sid, authenticated, last_visit)
+                              VALUES ('milsomd', 1, 0)""")
+        msg = self._create_new_message()
+        msg['groups'] = ["*"]
+        msg.insert()
+
+        def pending_rows():
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""SELECT username, message_name, mode
+                              FROM project_message_pending
+                              ORDER BY username""")
+            return cursor.fetchall()
+        self.assertEqual([("milsomd", "Test Term", "Alert")], pending_rows())
+
+        names = lambda msgs: [m['name'] for m in msgs]
+        self.assertEqual(["Test Term"], names(
+            ProjectMessage.get_unagreed_messages(self.env, "milsomd")))
+        # users unknown when the message was created are fanned out later
+        self.assertEqual(["Test Term"], names(
+            ProjectMessage.get_unagreed_messages(self.env, "goldinge")))
+        self.assertEqual([("goldinge", "Test Term", "Alert"), 
+                          ("milsomd", "Test Term", "Alert")], pending_rows())
+
+        ProjectMessageRecord.insert_many(self.env, ["Test Term"], "milsomd")
+        self.assertEqual([("goldinge", "Test Term", "Alert")], pending_rows())
+        self.assertEqual([], 
+            ProjectMessage.get_unagreed_messages(self.env, "milsomd"))
+
+    def test_pending_without_session(self):
+        msg = self._create_new_message()
+        msg['groups'] = ["*"]
+        msg.insert()
+        names = lambda msgs: [m['name'] for m in msgs]
+        # clarki has no session, so is fanned out when first looked up
+        self.assertEqual(["Test Term"], names(
+            ProjectMessage.get_unagreed_messages(self.env, "clarki")))
+
+        second = self._create_new_message()
+        second['name'] = "Another Test Term"
+        second['groups'] = ["*"]
+        second['created_at'] = "1396975221114383"
+        second.insert()
+        ProjectMessageSystem(self.env).pending_cache.clear()
+        self.assertEqual(["Test Term", "Another Test Term"], names(
+            ProjectMessage.get_unagreed_messages(self.env, "clarki")))
+
+    def test_pending_after_joining_group(self):
+        msg = self._create_new_message()
+        msg.insert()
+        system = ProjectMessageSystem(self.env)
+        system.membership_cache.set("milsomd", frozenset())
+        self.assertEqual([], 
+            ProjectMessage.get_unagreed_messages(self.env, "milsomd"))
+
+        # milsomd joins the group once their cached memberships expire
+        system.membership_cache.set("milsomd", 
+                                    frozenset(["project_managers"]))
+        system.pending_cache.discard("milsomd")
+        self.assertEqual(["Test Term"], [m['name'] for m in 
+            ProjectMessage.get_unagreed_messages(self.env, "milsomd")])
+
+    def test_get_unagreed_message_names(self):
+        msg = self._create_new_message()
+        msg['groups'] = ["*"]
+        msg.insert()
+        upcoming = self._create_new_message()
+        upcoming['name'] = "Upcoming Term"
+        upcoming['mode'] = "Full Screen"
+        upcoming['groups'] = ["*"]
+        upcoming['created_at'] = "1396975221114383"
+        upcoming['start'] = self.end_date
+        upcoming['end'] = (datetime.now() + 
+                           timedelta(days=5)).strftime("%Y-%m-%d")
+        upcoming.insert()
+        managers = self._create_new_message()
+        managers['name'] = "Managers Term"
+        managers.insert()
+
+        self.assertEqual([("Test Term", "Alert")], 
+            ProjectMessage.get_unagreed_message_names(self.env, "milsomd"))
+        self.assertEqual([("Test Term", "Alert"), 
+                          ("Upcoming Term", "Full Screen")], 
+            ProjectMessage.get_unagreed_message_names(self.env, "milsomd", 
+                                                      upcoming=True))
+        self.assertEqual([("Upcoming Term", "Full Screen")], 
+            ProjectMessage.get_unagreed_message_names(self.env, "milsomd", 
+                                        mode="Full Screen", upcoming=True))
+
+        ProjectMessageRecord.insert_many(self.env, ["Test Term"], "milsomd")
+        self.assertEqual([], 
+            ProjectMessage.get_unagreed_message_names(self.env, "milsomd"))
+
+    def test_group_memberships(self):
+        memberships = ProjectMessage.get_group_memberships_many(self.env, 
+                                                ["milsomd", "goldinge"])
+        self.assertEqual(set(["milsomd", "goldinge"]), set(memberships))
+        # bulk lookups do not fill the cache used for requests
+        cache = ProjectMessageSystem(self.env).membership_cache
+        self.assertEqual(0, len(cache))
+        ProjectMessage.get_group_memberships(self.env, "goldinge")
+        cache.set("milsomd", frozenset(["project_managers"]))
+        self.assertEqual(frozenset(["project_managers"]), 
+                 ProjectMessage.get_group_memberships(self.env, "milsomd"))
+
+        ProjectMessage.invalidate_group_memberships(self.env, ["milsomd"])
+        self.assertFalse("milsomd" in cache)
+        self.assertTrue("goldinge" in cache)
+        ProjectMessage.invalidate_group_memberships(self.env)
+        self.assertEqual(0, len(cache))
+
     def test_create_term(self):
         msg = self._create_new_message()
         self.assertEqual('Test Term', msg['name'])
@@ -118,6 +267,20 @@ class ProjectMessageTestCase(unittest.TestCase):
         all_msgs = ProjectMessage(self.env).get_filtered_messages(self.env)
         self.assertEqual(0, len(all_msgs))
 
+    def test_group_rows(self):
+        msg = self._create_new_message()
+        msg['groups'] = ["project_managers", "*"]
+        msg.insert()
+        def group_rows():
+            cursor = self.env.get_read_db().cursor()
+            cursor.execute("""SELECT group_name FROM project_message_group
+                              WHERE message_name=%s
+                              ORDER BY group_name""", (msg['name'],))
+            return [group for group, in cursor.fetchall()]
+        self.assertEqual(["*", "project_managers"], group_rows())
+        msg.hide()
+        self.assertEqual([], group_rows())
+
     def test_filtered_message_dates(self):
         # start date is before and end date is after today
         msg = self._create_new_message()
@@ -145,6 +308,77 @@ class ProjectMessageTestCase(unittest.TestCase):
         filtered_msgs = ProjectMessage.get_filtered_messages(self.env)
         self.assertEqual(0, len(filtered_msgs))
 
+    def test_message_row(self):
+        row = MessageRow.from_db(("Test Term", "Hello World!", "Agree", 
+                                  "Alert", '["*"]', 1396975221114382, 
+                                  1396975221114388, "milsomd", 
+                                  1396975221114382))
+        self.assertEqual("Test Term", row['name'])
+        self.assertEqual("Test Term", row[0])
+        self.assertEqual(["*"], row['groups'])
+        self.assertEqual(frozenset(["*"]), row.groups)
+        self.assertEqual(1396975221114388, row.end)
+        self.assertEqual(from_utimestamp(1396975221114388), row['end'])
+        self.assertEqual(from_utimestamp(1396975221114382), row['created_at'])
+        self.assertEqual(None, row['foo'])
+        def rename():
+            row['name'] = "Renamed"
+        self.assertRaises(TypeError, rename)
+
+    def test_unagreed_messages_by_mode(self):
+        alert = self._create_new_message()
+        full_screen = self._create_new_message()
+        full_screen['name'] = "Another Test Term"
+        full_screen['mode'] = "Full Screen"
+        unagreed = UnagreedMessages([alert, full_screen])
+        self.assertEqual(2, len(unagreed))
+        self.assertEqual([alert, full_screen], unagreed.get())
+        self.assertEqual([alert], unagreed.get('Alert'))
+        self.assertEqual([full_screen], unagreed.get('Full Screen'))
+        self.assertEqual([], UnagreedMessages([]).get('Alert'))
+
+
+class MessageIndexTestCase(unittest.TestCase):
+
+    def _row(self, name, groups, start, end):
+        return MessageRow(name, "Hello World!", "Agree", "Alert", 
+                          frozenset(groups) if groups is not None else None, 
+                          start, end, "milsomd", start)
+
+    def test_active_rows(self):
+        rows = (self._row("Expired", ["*"], 10, 20),
+                self._row("Hidden", None, 10, 200),
+                self._row("Managers", ["project_managers"], 50, 200),
+                self._row("Everyone", ["*"], 40, 180),
+                self._row("Future", ["*", "project_managers"], 150, 200))
+        index = MessageIndex(rows, 100)
+        self.assertEqual(set(["*", "project_managers"]), set(index.by_group))
+
+        names = lambda rows: [row[0] for row in rows]
+        self.assertEqual(["Managers", "Everyone"], names(index.active_rows()))
+        self.assertEqual(["Everyone"], names(index.active_rows(["*"])))
+        self.assertEqual(["Managers", "Everyone"], 
+                         names(index.active_rows(["project_managers", "*"])))
+        self.assertEqual([], names(index.active_rows(["developers"])))
+
+    def test_next_boundary(self):
+        rows = (self._row("Everyone", ["*"], 40, 180),
+                self._row("Future", ["*"], 150, 200))
+        index = MessageIndex(rows, 100)
+        self.assertEqual(150, index.next_boundary)
+        self.assertEqual(False, index.expired(149))
+        self.assertEqual(True, index.expired(150))
+
+        index = MessageIndex(rows, 150)
+        self.assertEqual(180, index.next_boundary)
+        self.assertEqual(["Everyone", "Future"], 
+                         [row[0] for row in index.active_rows()])
+
+        index = MessageIndex(rows, 200)
+        self.assertEqual(None, index.next_boundary)
+        self.assertEqual(False, index.expired(10 ** 18))
+        self.assertEqual([], index.active_rows())
+
 
 class ProjectMessageRecordTestCase(unittest.TestCase):
 
@@ -208,6 +442,127 @@ class ProjectMessageRecordTestCase(unittest.TestCase):
         self.assertEqual("goldinge", all_records[1]['agreed_by'])
         self.assertEqual(from_utimestamp(1396975221114388), all_records[1]['agreed_at'])
 
+    def test_insert_many(self):
+        ProjectMessageRecord.insert_many(self.env, 
+                                         ["Test Case", "Another Test Case"],
+                                         "milsomd", 1396975221114382)
+        user_records = ProjectMessageRecord.get_user_records(self.env, "milsomd")
+        self.assertEqual(["Another Test Case", "Test Case"], 
+                         sorted(r['message_name'] for r in user_records))
+        self.assertEqual(2, len(ProjectMessageRecord.get_all_records(self.env)))
+
+    def test_insert_is_idempotent(self):
+        self._create_new_record().insert()
+        self._create_new_record().insert()
+        ProjectMessageRecord.insert_many(self.env, ["Test Case", "Test Case"],
+                                         "milsomd")
+        user_records = ProjectMessageRecord.get_user_records(self.env, "milsomd")
+        self.assertEqual(1, len(user_records))
+        self.assertEqual(from_utimestamp(1396975221114382), 
+                         user_records[0]['agreed_at'])
+
+    def test_write_behind(self):
+        self.env.config.set('projectmessage', 'write_behind', 'true')
+        writer = ProjectMessageSystem(self.env).record_writer
+        ProjectMessageRecord.agree(self.env, ["Test Case"], "milsomd")
+        self.assertEqual(set(["Test Case"]), writer.queued_names("milsomd"))
+        writer.close()
+        self.assertEqual(set(), writer.queued_names("milsomd"))
+        user_records = ProjectMessageRecord.get_user_records(self.env, "milsomd")
+        self.assertEqual(["Test Case"], 
+                         [r['message_name'] for r in user_records])
+
+    def test_generations(self):
+        self.env.config.set('projectmessage', 'generation_poll_interval', '0')
+        self.assertEqual([], 
+            ProjectMessageRecord.get_user_records(self.env, "milsomd"))
+        self.assertEqual([], 
+            ProjectMessageRecord.get_user_records(self.env, "goldinge"))
+
+        # a record added by another process
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.execute("""INSERT INTO project_message_record 
+                                (message_name, agreed_by, agreed_at)
+                              VALUES ('Test Case', 'milsomd', 1)""")
+            ProjectMessageSystem(self.env).bump_generations(db, 
+                                                ['records:milsomd'])
+        cache = ProjectMessageSystem(self.env).record_cache
+        self.assertTrue("milsomd" in cache)
+        user_records = ProjectMessageRecord.get_user_records(self.env, "milsomd")
+        self.assertEqual(["Test Case"], 
+                         [r['message_name'] for r in user_records])
+        # other users are unaffected, and changes only invalidate once
+        self.assertTrue("goldinge" in cache)
+        ProjectMessageRecord.get_user_records(self.env, "goldinge")
+        self.assertTrue("milsomd" in cache)
+
+        # later changes advance the scope's single generation row
+        @self.env.with_transaction()
+        def do_bump(db):
+            ProjectMessageSystem(self.env).bump_generations(db, 
+                                                ['records:milsomd'])
+        ProjectMessageRecord.get_user_records(self.env, "goldinge")
+        self.assertFalse("milsomd" in cache)
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("""SELECT COUNT(*) FROM project_message_generation
+                          WHERE scope='records:milsomd'""")
+        self.assertEqual([(1,)], cursor.fetchall())
+
+    def test_get_records_page(self):
+        for i, user in enumerate(["milsomd", "goldinge", "clarki"]):
+            ProjectMessageRecord.insert_many(self.env, 
+                                             ["Test Case", "Another Test Case"],
+                                             user, 1396975221114382 + i)
+        records, next_key = ProjectMessageRecord.get_records_page(self.env, 4)
+        self.assertEqual(4, len(records))
+        self.assertEqual((records[-1].agreed_at, records[-1].record_id), 
+                         next_key)
+        more, next_key = ProjectMessageRecord.get_records_page(self.env, 4, 
+                                                               next_key)
+        self.assertEqual(2, len(more))
+        self.assertEqual(None, next_key)
+        self.assertEqual(range(1, 7), [r.record_id for r in records + more])
+
+        records, next_key = ProjectMessageRecord.get_records_page(self.env, 
+                                10, descending=True, message_name="Test Case",
+                                start=1396975221114383)
+        self.assertEqual(["clarki", "goldinge"], 
+                         [r.agreed_by for r in records])
+        records, next_key = ProjectMessageRecord.get_records_page(self.env, 
+                                10, agreed_by="milsomd", 
+                                end=1396975221114383)
+        self.assertEqual(2, len(records))
+
+    def test_export_records(self):
+        for i, user in enumerate(["milsomd", "goldinge", "clarki"]):
+            ProjectMessageRecord.insert_many(self.env, ["Test Case"], user,
+                                             1396975221114382 + i)
+        records = list(ProjectMessageRecord.iter_records(self.env, 
+                                                         chunk_size=2))
+        self.assertEqual(["milsomd", "goldinge", "clarki"], 
+                         [r.agreed_by for r in records])
+
+        lines = "".join(export.iter_csv(records, buffer_size=1)).splitlines()
+        self.assertEqual("record_id,message_name,agreed_by,agreed_at", 
+                         lines[0])
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[1].startswith("1,Test Case,milsomd,2014-04-08"))
+
+        exported = json.loads("".join(export.iter_json(records, 
+                                                       buffer_size=1)))
+        self.assertEqual(["milsomd", "goldinge", "clarki"], 
+                         [r['agreed_by'] for r in exported])
+        self.assertEqual([], json.loads("".join(export.iter_json([]))))
+
+    def test_record_row(self):
+        row = RecordRow(1, "Test Case", "milsomd", 1396975221114382)
+        self.assertEqual("Test Case", row['message_name'])
+        self.assertEqual(1396975221114382, row.agreed_at)
+        self.assertEqual(from_utimestamp(1396975221114382), row['agreed_at'])
+        self.assertEqual(None, row['foo'])
+
     def test_get_user_records(self):
         record = self._create_new_record()
         record.insert()
@@ -225,6 +580,7 @@ class ProjectMessageRecordTestCase(unittest.TestCase):
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ProjectMessageTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(MessageIndexTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ProjectMessageRecordTestCase, 'test'))
     return suite
 
@@ -0,0 +1,25 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+# the table is recreated with a row per scope rather than per change, 
+# starting with the scopes which always have one
+schema = [
+    Table('project_message_generation', key='scope')[
+        Column('scope'),
+        Column('generation', type='int64'),
+        Index(['generation']),
+        ],
+    ]
+
+def do_upgrade(env, i, cursor):
+    cursor.execute("DROP TABLE project_message_generation")
+    db_connector, _ = DatabaseManager(env).get_connector()
+    for table in schema:
+        for statement in db_connector.to_sql(table):
+            cursor.execute(statement)
+    cursor.executemany("""INSERT INTO project_message_generation 
+                            (scope, generation)
+                          VALUES (%s, 0)""", 
+                       [('messages',), ('groups',)])
@@ -0,0 +1,17 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+# Index names follow the convention used by the trac database connectors, 
+# so a new environment and an upgraded environment end up with the same 
+# indexes.
+indexes = [
+    ('project_message', ['name'], True),
+    ('project_message_record', ['agreed_by', 'message_name'], False),
+    ('project_message_record', ['agreed_at'], False),
+    ]
+
+def do_upgrade(env, i, cursor):
+    for table, columns, unique in indexes:
+        cursor.execute("CREATE %sINDEX %s_%s_idx ON %s (%s)"
+                       % ('UNIQUE ' if unique else '', table, 
+                          '_'.join(columns), table, ','.join(columns)))
@@ -0,0 +1,30 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+import json
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('project_message_group', key=('message_name', 'group_name'))[
+        Column('message_name'),
+        Column('group_name'),
+        Index(['group_name']),
+        ],
+    ]
+
+def do_upgrade(env, i, cursor):
+    db_connector, _ = DatabaseManager(env).get_connector()
+    for table in schema:
+        for statement in db_connector.to_sql(table):
+            cursor.execute(statement)
+
+    # hidden messages have a NULL groups column, and no group rows
+    cursor.execute("""SELECT name, groups
+                      FROM project_message
+                      WHERE groups IS NOT NULL""")
+    rows = [(name, group) for name, groups in cursor.fetchall()
+            for group in set(json.loads(groups))]
+    cursor.executemany("""INSERT INTO project_message_group 
+                            (message_name, group_name)
+                          VALUES (%s, %s)""", rows)
@@ -0,0 +1,15 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+def do_upgrade(env, i, cursor):
+    # keep the first record of each user agreeing to a message
+    cursor.execute("""DELETE FROM project_message_record
+                      WHERE record_id NOT IN (
+                        SELECT MIN(record_id)
+                        FROM project_message_record
+                        GROUP BY agreed_by, message_name)""")
+    cursor.execute("""DROP INDEX 
+                      project_message_record_agreed_by_message_name_idx""")
+    cursor.execute("""CREATE UNIQUE INDEX 
+                      project_message_record_agreed_by_message_name_idx
+                      ON project_message_record (agreed_by, message_name)""")
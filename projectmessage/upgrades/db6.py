@@ -0,0 +1,62 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+import json
+
+from trac.db import Table, Column, DatabaseManager
+
+from simplifiedpermissionsadminplugin import SimplifiedPermissions
+
+schema = [
+    Table('project_message_stats', key='message_name')[
+        Column('message_name'),
+        Column('targeted', type='int'),
+        Column('agreed', type='int'),
+        ],
+    ]
+
+def do_upgrade(env, i, cursor):
+    db_connector, _ = DatabaseManager(env).get_connector()
+    for table in schema:
+        for statement in db_connector.to_sql(table):
+            cursor.execute(statement)
+
+    cursor.execute("""SELECT message_name, COUNT(*)
+                      FROM project_message_record
+                      GROUP BY message_name""")
+    agreed = dict(cursor.fetchall())
+
+    # the users ProjectMessage.get_targeted_users() counts, other than 
+    # fanned out users, which are only known from later versions
+    cursor.execute("""SELECT sid
+                      FROM session
+                      WHERE authenticated=1
+                      UNION
+                      SELECT agreed_by
+                      FROM project_message_record""")
+    usernames = [sid for sid, in cursor.fetchall()]
+    # resolved on first use, and without the plugin's caches, which rely 
+    # on tables later upgrades create
+    memberships = {}
+    def targeted(groups):
+        groups = set(groups)
+        if "*" in groups:
+            return len(usernames)
+        if not memberships:
+            sp = SimplifiedPermissions(env)
+            for username in usernames:
+                memberships[username] = set(
+                    sp.group_memberships_for_user(username))
+        return sum(1 for username in usernames
+                   if groups.intersection(memberships[username]))
+
+    # hidden messages have a NULL groups column, so are no longer targeted
+    cursor.execute("""SELECT name, groups
+                      FROM project_message""")
+    rows = [(name, 
+             targeted(json.loads(groups)) if groups is not None else 0, 
+             agreed.get(name, 0))
+            for name, groups in cursor.fetchall()]
+    cursor.executemany("""INSERT INTO project_message_stats 
+                            (message_name, targeted, agreed)
+                          VALUES (%s, %s, %s)""", rows)
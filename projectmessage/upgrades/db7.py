@@ -0,0 +1,25 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+# the tables start empty - each user's pending messages are fanned out 
+# the first time they are looked up, see ProjectMessage.fan_out_user()
+schema = [
+    Table('project_message_pending', key=('username', 'message_name'))[
+        Column('username'),
+        Column('message_name'),
+        Column('mode'),
+        Index(['message_name']),
+        ],
+    Table('project_message_fanout', key='username')[
+        Column('username'),
+        Column('fanned_out_at', type='int64'),
+        ],
+    ]
+
+def do_upgrade(env, i, cursor):
+    db_connector, _ = DatabaseManager(env).get_connector()
+    for table in schema:
+        for statement in db_connector.to_sql(table):
+            cursor.execute(statement)
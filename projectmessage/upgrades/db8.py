@@ -0,0 +1,18 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('project_message_generation')[
+        Column('scope'),
+        Column('generation', type='int64'),
+        Index(['generation']),
+        ],
+    ]
+
+def do_upgrade(env, i, cursor):
+    db_connector, _ = DatabaseManager(env).get_connector()
+    for table in schema:
+        for statement in db_connector.to_sql(table):
+            cursor.execute(statement)
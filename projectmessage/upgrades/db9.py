@@ -0,0 +1,21 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+from trac.db import Table, Column, DatabaseManager
+
+# the table is recreated empty, with the groups each user was fanned out 
+# for - users are fanned out again the next time they are looked up
+schema = [
+    Table('project_message_fanout', key='username')[
+        Column('username'),
+        Column('groups'),
+        Column('fanned_out_at', type='int64'),
+        ],
+    ]
+
+def do_upgrade(env, i, cursor):
+    cursor.execute("DROP TABLE project_message_fanout")
+    db_connector, _ = DatabaseManager(env).get_connector()
+    for table in schema:
+        for statement in db_connector.to_sql(table):
+            cursor.execute(statement)
@@ -3,29 +3,35 @@
 
 import copy
 from datetime import datetime, timedelta
+import hashlib
 from genshi.builder import tag
-from genshi.filters.transform import Transformer
+from genshi.core import START, END
 import itertools
 from pkg_resources import resource_filename
 import pytz
+import re
 
 from trac.admin.api import IAdminPanelProvider
-from trac.config import Option, ListOption
-from trac.core import Component, implements
+from trac.config import IntOption, Option, ListOption
+from trac.core import Component, TracError, implements
 from trac.mimeview import Context
+from trac.perm import PermissionCache
 from trac.prefs import IPreferencePanelProvider
 from trac.resource import ResourceNotFound
-from trac.util.datefmt import to_utimestamp, from_utimestamp
+from trac.util.datefmt import parse_date, to_utimestamp
 from trac.util.presentation import to_json
 from trac.web import ITemplateStreamFilter
-from trac.web.api import IRequestHandler
+from trac.web.api import IRequestHandler, RequestDone
 from trac.web.chrome import (ITemplateProvider, add_stylesheet,
                              Chrome, add_notice, add_script, add_warning)
 from trac.web.main import IRequestFilter
 from trac.wiki.formatter import format_to_html
 
+from projectmessage import export
 from projectmessage.api import ProjectMessageSystem
-from projectmessage.models import ProjectMessage, ProjectMessageRecord
+from projectmessage.cache import LRUCache
+from projectmessage.models import (ProjectMessage, ProjectMessageRecord,
+                                   UnagreedMessages)
 from simplifiedpermissionsadminplugin.model import Group
 
 
@@ -35,19 +41,57 @@ class ProjectMessageUI(Component):
     to create and send messages to project members through the user interface.
 
     You can set the timeout_period to reduce the number of database queries 
-    executed with each request. We set a session attribute to track this, 
-    and compare this timestamp to see if we should query for new notifications.
+    executed with each request. Once a user has no notifications left to 
+    see, we store a deadline of now plus the timeout_period, and do not 
+    query for new notifications until it passes or a new message is 
+    published. The deadlines are kept in memory by each process, rather 
+    than in the session table, so showing a page never writes to the 
+    database.
     """
 
     implements (IRequestHandler, IAdminPanelProvider, ITemplateStreamFilter,
                 ITemplateProvider, IRequestFilter, IPreferencePanelProvider)
 
-    timeout_period = Option('projectmessage', 'timeout_period', 
-                    timedelta(minutes=10))
+    timeout_period = Option('projectmessage', 'timeout_period', '600',
+                    doc="""Number of seconds to wait before checking again 
+                    for project messages a user has not agreed to. Values 
+                    in the H:MM:SS format are also accepted. Publishing a 
+                    new message ends the wait early.""")
 
     url_requests = ListOption('projectmessage', 'url_requests', 
                     ['/projectmessage', '/ajax/projectmessage'])
 
+    included_paths = ListOption('projectmessage', 'included_paths', [],
+                    doc="""If set, project messages are only shown on pages 
+                    whose path starts with one of these prefixes.""")
+
+    excluded_paths = ListOption('projectmessage', 'excluded_paths', 
+                    ['/projectmessage', '/chrome', '/login', '/rpc', 
+                     '/xmlrpc', '/shib-session-initiator', '/adfs'],
+                    doc="""Project messages are never shown on pages whose 
+                    path starts with one of these prefixes.""")
+
+    excluded_templates = ListOption('projectmessage', 'excluded_templates', 
+                    [], doc="""Alert messages are never added to pages 
+                    rendered with one of these templates.""")
+
+    records_page_size = IntOption('projectmessage', 'records_page_size', 100,
+                    doc="""Number of records shown on each page of the 
+                    project message records admin panel.""")
+
+    rendered_cache_size = IntOption('projectmessage', 'rendered_cache_size',
+                    100, doc="Maximum number of project messages whose "
+                             "rendered HTML is cached in each process.")
+
+    def __init__(self):
+        # maps usernames to their timeout deadline
+        self._deadlines = LRUCache(
+                            ProjectMessageSystem(self.env).pending_cache_size)
+        # maps message name, text hash and base url to the rendered HTML
+        self._rendered = LRUCache(self.rendered_cache_size)
+        self._included = _prefix_regexp(self.included_paths)
+        self._excluded = _prefix_regexp(self.excluded_paths)
+
     # IAdminPanelProvider methods 
 
     def get_admin_panels(self, req):
@@ -65,15 +109,11 @@ class ProjectMessageUI(Component):
                 'PROJECTMESSAGE_CREATE' in req.perm):
 
                 groups = (sid for sid in Group.groupsBy(self.env))
-                previous_msgs = ProjectMessage.get_all_messages(self.env)
-                for m in previous_msgs:
-                    for k in ('created_at', 'start', 'end'):
-                        m[k] = m[k].strftime('%Y-%m-%d')
-
                 data = {
                         'mode_options': ProjectMessageSystem(self.env).mode_options,
                         'group_options': itertools.chain(groups, ['*']),
-                        'msgs': previous_msgs,
+                        'msgs': ProjectMessage.get_all_messages(self.env),
+                        'stats': ProjectMessage.get_message_stats(self.env),
                         'start_date': datetime.now().strftime("%Y-%m-%d"),
                         'end_date': (datetime.now() + 
                                      timedelta(days=7)).strftime("%Y-%m-%d"),
@@ -136,25 +176,108 @@ class ProjectMessageUI(Component):
                     else:
                         add_notice(req, "New project message created.")
                         self.log.info("New project message '%s' created", name)
-                        # don't show a timestamp to the user - bad UI
-                        new_msg['created_at'] = from_utimestamp(new_msg['created_at']).strftime('%Y-%m-%d')
-                        data['msgs'].append(new_msg)
+                        data['msgs'] = ProjectMessage.get_all_messages(self.env)
+                        data['stats'] = ProjectMessage.get_message_stats(self.env)
 
                 return 'project_message_admin.html', data
 
             elif (page == 'project-message-records' and 
                 'PROJECTMESSAGE_VIEW' in req.perm):
 
-                records = ProjectMessageRecord.get_all_records(self.env)
-                for r in records:
-                    r['agreed_at'] = r['agreed_at'].strftime("%Y-%m-%d %H:%M")
+                format = req.args.get('format')
+                filters = self._get_record_filters(req, 
+                                        strict=format in export.formats)
+                if format in export.formats:
+                    self._send_export(req, format, filters)
 
+                descending = req.args.get('order') == 'desc'
+                after = None
+                if req.args.get('after'):
+                    try:
+                        after = tuple(int(v) for v in 
+                                      req.args.get('after').split(':', 1))
+                    except ValueError:
+                        after = None
+                    if after is None or len(after) != 2:
+                        after = None
+                        add_warning(req, "Invalid page requested.")
+
+                records, next_key = ProjectMessageRecord.get_records_page(
+                                        self.env, self.records_page_size, 
+                                        after, descending, **filters)
+
+                args = dict((k, req.args.get(k) or None) 
+                            for k in ('message_name', 'agreed_by', 
+                                      'from', 'to'))
+                args['order'] = 'desc' if descending else None
                 data = {
                         'records': records,
+                        'filters': args,
+                        'descending': descending,
+                        'first_href': req.href.admin(cat, page, **args),
+                        'next_href': None,
+                        'order_href': req.href.admin(cat, page, **dict(args, 
+                                        order=None if descending else 'desc')),
+                        'export_hrefs': [(format, req.href.admin(cat, page, 
+                                                    format=format, **args))
+                                         for format in sorted(export.formats)],
                 }
+                if next_key:
+                    data['next_href'] = req.href.admin(cat, page, 
+                                            after='%d:%d' % next_key, **args)
 
                 return 'project_message_records.html', data
 
+    def _get_record_filters(self, req, strict=False):
+        """
+        Returns the project message record filters in the request arguments, 
+        as keyword arguments for ProjectMessageRecord.get_records_page(). 
+        Dates are inclusive, and given in the YYYY-MM-DD format.
+
+        An invalid date is ignored with a warning, or if strict is True, 
+        raises a TracError - an export can not show a warning, and must 
+        not silently include records outside the requested dates.
+        """
+
+        filters = {
+            'message_name': req.args.get('message_name') or None,
+            'agreed_by': req.args.get('agreed_by') or None,
+        }
+        for arg, key, offset in (('from', 'start', timedelta(0)),
+                                 ('to', 'end', timedelta(days=1))):
+            filters[key] = None
+            if req.args.get(arg):
+                try:
+                    date = parse_date(req.args.get(arg), req.tz)
+                except TracError:
+                    if strict:
+                        raise TracError("Incorrect format for date. "
+                                        "Should be YYYY-MM-DD")
+                    add_warning(req, "Incorrect format for date. "
+                                     "Should be YYYY-MM-DD")
+                else:
+                    filters[key] = to_utimestamp(date + offset)
+        return filters
+
+    def _send_export(self, req, format, filters):
+        """
+        Streams every record matching the filters to the client in the 
+        requested export format. The records are read and encoded in 
+        chunks, so memory use does not grow with the size of the table.
+        """
+
+        mimetype, encoder = export.formats[format]
+        records = ProjectMessageRecord.iter_records(self.env, **filters)
+        req.send_response(200)
+        req.send_header('Content-Type', mimetype + ';charset=utf-8')
+        req.send_header('Content-Disposition', 
+                        'attachment; filename=project_message_records.%s' 
+                        % format)
+        req.end_headers()
+        for chunk in encoder(records):
+            req.write(chunk)
+        raise RequestDone
+
     # IPreferencePanelProvider methods
 
     def get_preference_panels(self, req):
@@ -163,9 +286,7 @@ class ProjectMessageUI(Component):
     def render_preference_panel(self, req, panel):
 
         agreed = ProjectMessageRecord.get_user_records(self.env, req.authname)
-        for m in agreed:
-            m['agreed_at'] = m['agreed_at'].strftime("%Y-%m-%d %H:%M")
-        disagreed = ProjectMessage.get_unagreed_messages(self.env, req.authname)
+        disagreed = self._unagreed_messages(req).get()
 
         data = {
             'agreed': agreed,
@@ -185,24 +306,14 @@ class ProjectMessageUI(Component):
         before their original request is processed.
         """
 
-        if req.authname != 'anonymous':
+        if handler != self and self._wants_messages(req):
             timeout_exceeded = self._timeout_limit_exceeded(req)
             if timeout_exceeded or timeout_exceeded is None:
-
-                if (not req.path_info.startswith('/projectmessage') and not
-                        req.path_info.startswith('/chrome') and not
-                        req.path_info.startswith('/login') and not
-                        req.path_info.startswith('/rpc') and not
-                        req.path_info.startswith('/xmlrpc') and not
-                        req.path_info.startswith('/shib-session-initiator') and not
-                        req.path_info.startswith('/adfs') and
-                        handler != self):
-                    pm = ProjectMessage
-                    unagreed_full_screen = pm.get_unagreed_messages(self.env, 
-                                                req.authname, 'Full Screen')
-                    if unagreed_full_screen:
-                        m = unagreed_full_screen[0] # only show one at a time
-                        return req.redirect(req.href.projectmessage(m['name']))
+                unagreed_full_screen = self._unagreed_messages(req).get(
+                                            'Full Screen')
+                if unagreed_full_screen:
+                    m = unagreed_full_screen[0] # only show one at a time
+                    return req.redirect(req.href.projectmessage(m['name']))
 
         return handler
 
@@ -221,9 +332,10 @@ class ProjectMessageUI(Component):
 
     def process_request(self, req):
         """
-        If the request is AJAX, inserts a new row into the record table for 
-        the authenticated user to show they have seen a particular 
-        notification.
+        If the request is AJAX, inserts new rows into the record table for 
+        the authenticated user to show they have seen the notifications 
+        named in the request. Several notifications can be acknowledged at 
+        once by repeating the name argument.
 
         If the request is a normal GET, try and show the appropriate full 
         screen project message.
@@ -247,27 +359,28 @@ class ProjectMessageUI(Component):
                     data = {
                         'name': msg['name'],
                         'message': msg['message'],
+                        'message_html': self._render_message(req, msg),
                         'button': msg['button'],
                     }
                     return 'project_message.html', data, None
-            data = {'message': 'No project messages to show.'}
+            data = {
+                'message': 'No project messages to show.',
+                'message_html': tag.p('No project messages to show.'),
+            }
             return 'project_message.html', data, None
 
         elif (req.method == 'POST' and
                 req.path_info.startswith('/ajax/projectmessage')):
-            if req.args.get('name'):
-                new_record = ProjectMessageRecord(self.env)
-                new_record.populate(req)
+            names = req.args.getlist('name')
+            if names:
                 try:
-                    new_record.insert()
+                    ProjectMessageRecord.agree(self.env, names, req.authname)
                 except:
-                    self.log.info("Unable to create record that %s agreed "
-                                  " to %s", new_record['agreed_by'], 
-                                  new_record['message_name'])
-                finally:
-                    self.log.debug("Created a new record to show %s agreed "
-                                   "to %s", new_record['agreed_by'],
-                                   new_record['message_name'])
+                    self.log.info("Unable to create records that %s agreed "
+                                  "to %s", req.authname, ', '.join(names))
+                else:
+                    self.log.debug("Created records to show %s agreed "
+                                   "to %s", req.authname, ', '.join(names))
                 data = {'success': True}
                 req.send(to_json(data), 'text/json')
 
@@ -280,65 +393,34 @@ class ProjectMessageUI(Component):
         If there are any project messages that the authenticated user has not 
         seen, which are selected to be viewed as alert based notifications, 
         we add the necessary mark-up and javscript.
+
+        Nothing is done for responses which are not HTML, or for templates 
+        listed in the excluded_templates option.
         """
 
-        if req.authname != 'anonymous':
+        if (method in ('xhtml', 'html') and 
+                filename not in self.excluded_templates and
+                self._wants_messages(req)):
 
             timeout_exceeded = self._timeout_limit_exceeded(req)
             if timeout_exceeded or timeout_exceeded is None:
 
                 # we can check for alert notifications
-                unagreed = ProjectMessage.get_unagreed_messages(self.env, 
-                            req.authname, 'Alert')
-                if unagreed:
+                unagreed = self._unagreed_messages(req)
+                alerts = unagreed.get('Alert')
+                if alerts:
                     # we only shown one notification at a time currently
-                    msg = unagreed[0]
-                    msg['message'] = format_to_html(self.env, 
-                                        Context.from_request(req), msg['message'])
-                    alert_markup = tag(
-                                    tag.div(
-                                        tag.i(
-                                            class_="alert-icon fa fa-info-circle"
-                                        ),
-                                        tag.ul(
-                                            tag.li(msg['message'],
-                                                class_="alert-message"
-                                            ),
-                                        ),
-                                        tag.button(msg['button'],
-                                            class_="close btn btn-mini",
-                                            type="button",
-                                            data_dismiss="alert"
-                                        ),
-                                        class_="project-message cf alert alert-info alert-dismissable individual"
-                                    ),
-                                    tag.form(
-                                        tag.input(
-                                            name="name",
-                                            value=msg['name'],
-                                            type="text",
-                                        ),
-                                        tag.input(
-                                            name="agree",
-                                            value=True,
-                                            type="text",
-                                        ),
-                                        class_="hidden",
-                                        method="post",
-                                        action="",
-                                    ),
-                                  )
-
-                    stream |= Transformer("//*[@id='main']/*[1]").before(alert_markup)
+                    msg = alerts[0]
+                    stream |= _insert_before_main(self._alert_events(req, msg))
                     add_script(req, 'projectmessage/js/project_message.js')
 
                 # if the timeout has been exceeded or does not exist yet, 
-                # and there are no notifications to show, we update the 
-                # session attribute table
-                if not ProjectMessage.get_unagreed_messages(self.env, req.authname):
-                    stamp = str(to_utimestamp(datetime.now(pytz.utc)))
-                    req.session['project_message_timeout'] = stamp
-                    req.session.save()
+                # and there are no notifications to show, we set a new 
+                # deadline for the user
+                if not unagreed:
+                    deadline = (to_utimestamp(datetime.now(pytz.utc)) + 
+                                self._timeout_period_usecs)
+                    self._deadlines.set(req.authname, deadline)
 
         return stream
 
@@ -352,18 +434,182 @@ class ProjectMessageUI(Component):
 
     # Other class methods
 
-    def _timeout_limit_exceeded(self, req):
+    def _unagreed_messages(self, req):
+        """
+        Returns an UnagreedMessages instance for the authenticated user.
+
+        This is computed lazily the first time it is needed and then 
+        stored on the request, so the request filter and stream filter 
+        share a single lookup.
+        """
+
+        if 'project_messages' not in req.callbacks:
+            req.callbacks['project_messages'] = lambda req: UnagreedMessages(
+                ProjectMessage.get_unagreed_messages(self.env, req.authname))
+        return req.project_messages
+
+    def _wants_messages(self, req):
+        """
+        Returns True if project messages can be shown in response to the 
+        request. They are not shown to anonymous users, in response to 
+        XMLHttpRequests, or for paths filtered out by the included_paths 
+        and excluded_paths options.
+        """
+
+        path = req.path_info
+        return (req.authname != 'anonymous' and
+                req.get_header('X-Requested-With') != 'XMLHttpRequest' and
+                not (self._excluded and self._excluded.match(path)) and
+                not (self._included and not self._included.match(path)))
+
+    def _render_message(self, req, msg):
+        """
+        Returns the wiki text of a project message formatted as HTML.
+
+        The result is cached by message name, a hash of the wiki text and 
+        the base URL, so a message shown to many users is only formatted 
+        once by each process. As the markup is shared between users, it is 
+        formatted with the permissions of an anonymous user, so nothing only 
+        some users may see is included. The request is kept in the context, 
+        as macros such as Image need it for the href and chrome.
+        """
+
+        key = ('message',) + self._cache_key(req, msg)
+        html = self._rendered.get(key)
+        if html is None:
+            context = Context.from_request(req)
+            context.perm = PermissionCache(self.env, 'anonymous')(
+                                                        context.resource)
+            html = format_to_html(self.env, context, msg['message'] or '')
+            self._rendered.set(key, html)
+        return html
+
+    def _alert_events(self, req, msg):
+        """
+        Returns the alert banner for a project message as a list of Genshi 
+        stream events. This is built once and cached in the same way as 
+        the rendered message text.
+
+        The banner is kept as events rather than serialized markup, so 
+        later filters still see its form - Trac adds the __FORM_TOKEN the 
+        agreement POST needs to pass its CSRF check.
+        """
+
+        key = ('alert',) + self._cache_key(req, msg)
+        events = self._rendered.get(key)
+        if events is None:
+            fragment = tag(
+                        tag.div(
+                            tag.i(
+                                class_="alert-icon fa fa-info-circle"
+                            ),
+                            tag.ul(
+                                tag.li(self._render_message(req, msg),
+                                    class_="alert-message"
+                                ),
+                            ),
+                            tag.button(msg['button'],
+                                class_="close btn btn-mini",
+                                type="button",
+                                data_dismiss="alert"
+                            ),
+                            class_="project-message cf alert alert-info alert-dismissable individual"
+                        ),
+                        tag.form(
+                            tag.input(
+                                name="name",
+                                value=msg['name'],
+                                type="text",
+                            ),
+                            tag.input(
+                                name="agree",
+                                value=True,
+                                type="text",
+                            ),
+                            class_="hidden",
+                            method="post",
+                            action="",
+                        ),
+                      )
+            events = list(fragment.generate())
+            self._rendered.set(key, events)
+        return events
+
+    def _cache_key(self, req, msg):
+        text = msg['message'] or ''
+        return (msg['name'], hashlib.sha1(text.encode('utf-8')).hexdigest(),
+                req.href())
+
+    @property
+    def _timeout_period_usecs(self):
+        """
+        Returns the timeout_period option in microseconds. The option can be 
+        a number of seconds, or a duration in the H:MM:SS format.
         """
-        Looks in session table to see if we have exceeded the timeout limit.
 
-        If the timeout limit has been exceeded, we return True. If the 
-        timeout_period hasn't been exceeded, we return False. If the 
-        timeout_period hasn't been set, we return None.
+        value = self.timeout_period.strip()
+        try:
+            seconds = 0
+            for part in value.split(':'):
+                seconds = seconds * 60 + int(part)
+        except ValueError:
+            self.log.warning("Invalid [projectmessage] timeout_period '%s', "
+                             "using 600 seconds instead.", value)
+            seconds = 600
+        return seconds * 1000000
+
+    def _timeout_limit_exceeded(self, req):
+        """
+        Looks up the deadline of the authenticated user to see if we have 
+        exceeded the timeout limit.
+
+        The deadline is a microsecond timestamp. If the deadline has 
+        passed, or a new project message has been published since the 
+        deadline was set, we return True. If the timeout_period hasn't been 
+        exceeded, we return False. If the deadline hasn't been set, we 
+        return None.
         """
 
-        timeout = req.session.get('project_message_timeout')
-        if timeout:
-            if timeout < str(to_utimestamp(datetime.now(pytz.utc))):
+        deadline = self._deadlines.get(req.authname)
+        if deadline:
+            now = to_utimestamp(datetime.now(pytz.utc))
+            if now >= deadline:
                 return True
-            else:
-                return False
+            set_at = deadline - self._timeout_period_usecs
+            return ProjectMessage.get_last_published(self.env) > set_at
+
+
+def _insert_before_main(events):
+    """
+    Returns a stream filter which inserts a list of events before the 
+    first child element of the element with the id "main".
+
+    This does the same as Transformer("//*[@id='main']/*[1]").before(), 
+    but only has to look at the attributes of each start tag up to the 
+    insertion point, and passes the rest of the stream through untouched.
+    """
+
+    def _filter(stream):
+        in_main = done = False
+        for kind, data, pos in stream:
+            if not done:
+                if in_main:
+                    if kind is START:
+                        for event in events:
+                            yield event
+                    if kind in (START, END):
+                        done = True
+                elif kind is START and data[1].get('id') == 'main':
+                    in_main = True
+            yield kind, data, pos
+    return _filter
+
+
+def _prefix_regexp(prefixes):
+    """
+    Returns a compiled regular expression matching any string which starts 
+    with one of the prefixes, or None if there are no prefixes.
+    """
+
+    if prefixes:
+        return re.compile('|'.join(re.escape(p) for p in prefixes))
@@ -0,0 +1,127 @@
+# Author: Danny Milsom <danny.milsom@cgi.com>
+# Copyright (C) 2014 CGI IT UK Ltd
+
+import atexit
+from threading import Condition, Thread
+import time
+
+
+class RecordWriter(object):
+    """
+    Queues project message records and writes them to the database in
+    batches from a background thread.
+
+    A batch is written once batch_size records are queued, or interval
+    seconds after the oldest queued record, whichever comes first. Any
+    queued records are written when the process exits.
+
+    If a batch can not be written, the error is logged and the batch is
+    dropped. The affected users are then shown the messages again once
+    their cached pending messages expire, and can agree to them again.
+    """
+
+    def __init__(self, env, batch_size, interval):
+        self.env = env
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = []
+        self._queued_at = None
+        # batches taken from the queue which are being written
+        self._writing = []
+        self._cond = Condition()
+        self._thread = None
+        self._closed = False
+
+    def put(self, records):
+        """
+        Queues (message_name, agreed_by, agreed_at) tuples to be written.
+        """
+
+        with self._cond:
+            if not self._queue:
+                self._queued_at = time.time()
+            self._queue.extend(records)
+            if self._closed:
+                records = self._take()
+            else:
+                records = None
+                if self._thread is None:
+                    self._start()
+                self._cond.notify()
+        if records:
+            self._write(records)
+
+    def queued_names(self, username):
+        """
+        Returns the set of message names queued as agreed by the user.
+        """
+
+        with self._cond:
+            return set(name for batch in [self._queue] + self._writing
+                       for name, agreed_by, agreed_at in batch
+                       if agreed_by == username)
+
+    def flush(self):
+        """Writes every queued record now, in the calling thread."""
+
+        with self._cond:
+            records = self._take()
+        self._write(records)
+
+    def close(self):
+        """Stops the background thread and writes any queued records."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def _start(self):
+        self._thread = Thread(target=self._run,
+                              name='projectmessage-record-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._queue) >= self.batch_size:
+                        break
+                    if self._queue:
+                        wait = self._queued_at + self.interval - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                if self._closed:
+                    return
+                records = self._take()
+            self._write(records)
+
+    def _take(self):
+        # must be called holding the lock
+        records, self._queue = self._queue, []
+        self._queued_at = None
+        if records:
+            self._writing.append(records)
+        return records
+
+    def _write(self, records):
+        if not records:
+            return
+        # imported here, as the models module imports this one indirectly
+        from projectmessage.models import ProjectMessageRecord
+        try:
+            ProjectMessageRecord.write_records(self.env, records)
+        except Exception:
+            self.env.log.error("Unable to write %d queued project message "
+                               "records", len(records), exc_info=True)
+        else:
+            self.env.log.debug("Wrote %d queued project message records",
+                               len(records))
+        finally:
+            with self._cond:
+                self._writing.remove(records)